@@ -6,7 +6,9 @@ or more contributor license agreements. Licensed under the Elastic License;
 you may not use this file except in compliance with the Elastic License.
 """
 import asyncio
+import multiprocessing
 import os
+import socket
 import sys
 
 import sentry_sdk
@@ -17,15 +19,46 @@ from gateway.database import connect
 from gateway.on_connect import on_connection
 
 
+def create_socket() -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # every worker binds its own socket to the port, and the kernel
+    # balances incoming connections between them.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('0.0.0.0', 6000))
+    return sock
+
+
 async def start():
-    load_dotenv()
     async with websockets.server.serve(
-        on_connection, '0.0.0.0', 6000, ping_interval=32, ping_timeout=32
+        on_connection, sock=create_socket(), ping_interval=32, ping_timeout=32
     ):
         sentry_sdk.init(dsn=os.environ['SENTRY_DSN'], traces_sample_rate=1.0)
         connect()
-        print('DEBUG:Starting to serve on port 6000', file=sys.stderr)
+        print(
+            f'DEBUG:Worker {os.getpid()} starting to serve on port 6000',
+            file=sys.stderr,
+        )
         await asyncio.Future()
 
 
-asyncio.run(start())
+def run():
+    if sys.platform == 'linux':
+        import uvloop
+
+        uvloop.install()
+
+    asyncio.run(start())
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    # each worker has its own registry and Kafka consumer, sessions are
+    # spread across them so encoding and dispatch scale past a single core.
+    workers = int(os.getenv('GATEWAY_WORKERS', os.cpu_count() or 1))
+    processes = [multiprocessing.Process(target=run) for _ in range(workers)]
+
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join()
@@ -5,13 +5,15 @@ Copyright Discend and/or licensed to Discend under one
 or more contributor license agreements. Licensed under the Elastic License;
 you may not use this file except in compliance with the Elastic License.
 """
+import asyncio
 import os
 from typing import Any, Literal, TypeVar
-from zlib import Z_SYNC_FLUSH
 
 import msgspec
+import zstandard as zstd
 from cassandra.auth import PlainTextAuthProvider
 from cassandra.cqlengine import columns, connection, models, query
+from cassandra.query import PreparedStatement
 
 
 def get_hosts(name: str):
@@ -23,21 +25,85 @@ def get_hosts(name: str):
 auth_provider = PlainTextAuthProvider(
     os.getenv('SCYLLA_USER'), os.getenv('SCYLLA_PASSWORD')
 )
-T = TypeVar('T', dict[str, Any], list[Any])
+S = TypeVar('S', bound=msgspec.Struct)
+KEYSPACE = 'derailed'
 NotFound = query.DoesNotExist
+# raised when a conditional (IF) write isn't applied
+NotApplied = query.LWTException
+# frames are compressed independently of each other, so one context serves every
+# session. it isn't thread-safe, which is fine since frames are only built on the loop.
+ZSTD_CCTX = zstd.ZstdCompressor(level=3)
+
+
+# hot read paths skip cqlengine's query building, and use statements prepared once.
+# tables partitioned by guild are read for every guild at once, with IN.
+# channels are only indexed by guild, which IN can't be used on.
+QUERIES = {
+    'guilds': f'SELECT * FROM {KEYSPACE}.guilds WHERE id IN ?',
+    'joined_guild_ids': f'SELECT guild_id FROM {KEYSPACE}.members WHERE user_id = ?',
+    'categories': f'SELECT * FROM {KEYSPACE}.category_channels WHERE guild_id = ?',
+    'text_channels': f'SELECT * FROM {KEYSPACE}.guild_text_channels WHERE guild_id = ?',
+    'roles': f'SELECT * FROM {KEYSPACE}.roles WHERE guild_id IN ?',
+    'features': f'SELECT guild_id, value FROM {KEYSPACE}.features WHERE guild_id IN ?',
+}
+STATEMENTS: dict[str, PreparedStatement] = {}
 
 
 def connect():
     connection.setup(
         get_hosts('SCYLLA_HOSTS'),
-        'derailed',
+        KEYSPACE,
         auth_provider=auth_provider,
         connect_timeout=100,
         retry_connect=True,
     )
 
+    session = connection.get_session()
 
-class Event(msgspec.Struct):
+    for name, cql in QUERIES.items():
+        STATEMENTS[name] = session.prepare(cql)
+
+
+def _settle(
+    future: asyncio.Future, rows: list[dict[str, Any]], exc: Exception | None
+) -> None:
+    # the awaiting task may have been cancelled while the driver was working
+    if future.done():
+        return
+
+    if exc is None:
+        future.set_result(rows)
+    else:
+        future.set_exception(exc)
+
+
+# runs a prepared statement without blocking the loop for the round trip.
+# rows come back as dicts, cqlengine sets the session up with a dict_factory.
+async def cql_exec(statement: str, *params: Any) -> list[dict[str, Any]]:
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    rows: list[dict[str, Any]] = []
+    response = connection.get_session().execute_async(STATEMENTS[statement], params)
+
+    # both are called from the driver's event thread, once per page
+    def on_page(page: list[dict[str, Any]]) -> None:
+        rows.extend(page)
+
+        if response.has_more_pages:
+            response.start_fetching_next_page()
+        else:
+            loop.call_soon_threadsafe(_settle, future, rows, None)
+
+    def on_error(exc: Exception) -> None:
+        loop.call_soon_threadsafe(_settle, future, rows, exc)
+
+    response.add_callbacks(on_page, on_error)
+    return await future
+
+
+# it can't be part of a reference cycle, so it is kept out of the GC.
+# array_like isn't used, it's decoded from producers that send maps.
+class Event(msgspec.Struct, frozen=True, gc=False):
     name: str
     data: dict
     guild_id: int | None = None
@@ -46,31 +112,51 @@ class Event(msgspec.Struct):
     user_ids: list[int] | None = None
 
 
-class WSMessage(msgspec.Struct):
-    op: int
-    d: dict[str, Any]
+# snowflakes and permission bitfields overflow JavaScript numbers,
+# so anything typed as a BigInt is sent to clients as a string.
+class BigInt(int):
+    pass
+
+
+def _enc_hook(obj: Any) -> Any:
+    if isinstance(obj, BigInt):
+        return str(obj)
 
+    raise NotImplementedError
 
-def encode(
-    data: dict[str, Any],
-    compressor: Any | None,
-    encoding: Literal['json', 'msgpack'],
-) -> bytes:
-    if encoding == 'json':
-        datafied = msgspec.json.encode(data)
-    elif encoding == 'msgpack':
-        datafied = msgspec.msgpack.encode(data)
 
-    if compressor is None:
-        return datafied.decode()
+def _dec_hook(type: type, obj: Any) -> Any:
+    if type is BigInt:
+        return BigInt(obj)
 
-    first_dataset = compressor.compress(datafied)
-    second_dataset = compressor.flush(Z_SYNC_FLUSH)
-    return first_dataset + second_dataset
+    raise NotImplementedError
+
+
+JSON_ENCODER = msgspec.json.Encoder(enc_hook=_enc_hook)
+MSGPACK_ENCODER = msgspec.msgpack.Encoder(enc_hook=_enc_hook)
+ENCODERS: dict[str, msgspec.json.Encoder | msgspec.msgpack.Encoder] = {
+    'json': JSON_ENCODER,
+    'msgpack': MSGPACK_ENCODER,
+}
+
+
+def to_struct(row: models.Model | dict[str, Any], struct: type[S]) -> S:
+    return msgspec.convert(row, struct, from_attributes=True, dec_hook=_dec_hook)
+
+
+def zstd_compress(data: bytes) -> bytes:
+    return ZSTD_CCTX.compress(data)
+
+
+def encode_raw(data: Any, encoding: Literal['json', 'msgpack']) -> msgspec.Raw:
+    return msgspec.Raw(ENCODERS[encoding].encode(data))
+
+
+EVENT_DECODER = msgspec.msgpack.Decoder(Event)
 
 
 def decode(data: bytes) -> Event:
-    return msgspec.msgpack.decode(data, type=Event)
+    return EVENT_DECODER.decode(data)
 
 
 class Guild(models.Model):
@@ -262,42 +348,3 @@ class Activity(models.Model):
     content: str = columns.Text()
     stream_url: str = columns.Text()
     emoji_id: int = columns.BigInt()
-
-
-def objectify(data: T, remove_guild_id_field: bool = False) -> T:
-    if isinstance(data, dict):
-        for k, v in data.items():
-            if (
-                isinstance(v, int)
-                and v > 2147483647
-                or isinstance(v, int)
-                and 'permissions' in k
-            ):
-                data[k] = str(v)
-            elif isinstance(v, list):
-                new_value = []
-
-                for item in v:
-                    if isinstance(item, (dict, list)):
-                        new_value.append(objectify(item))
-                    else:
-                        new_value.append(item)
-
-                data[k] = new_value
-            elif k == 'guild_id' and remove_guild_id_field:
-                data.pop(k)
-            elif k == 'channel_id' and remove_guild_id_field:
-                data.pop(k)
-
-    elif isinstance(data, list):
-        new_data = []
-
-        for item in data:
-            if isinstance(item, (dict, list)):
-                new_data.append(objectify(item))
-            else:
-                new_data.append(item)
-
-        data = new_data
-
-    return data
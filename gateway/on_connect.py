@@ -5,51 +5,53 @@ Copyright Discend and/or licensed to Discend under one
 or more contributor license agreements. Licensed under the Elastic License;
 you may not use this file except in compliance with the Elastic License.
 """
-# TODO: This module currently doesn't implement multiprocessing
-# for such a thing, scaling without it would be impossible, meaning implement this ASAP.
 import urllib.parse
 
 from websockets.server import WebSocketServerProtocol
 
 from gateway.v1 import v1Session
 
-SETTING_NOT_FOUND = (KeyError, IndexError)
-
 
 async def on_connection(ws: WebSocketServerProtocol, url: str):
-    settings = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+    version = compress = encoding = None
 
-    try:
-        version = settings['v'][0]
-    except SETTING_NOT_FOUND:
-        return await ws.close(4001, 'Invalid API version')
-    else:
-        if version not in ('1'):
-            return await ws.close(4001, 'Invalid API version')
+    for setting in url.partition('?')[2].split('&'):
+        key, _, value = setting.partition('=')
+
+        # same as parse_qs: blank values count as missing, the first value of a
+        # repeated key wins, and percent-escapes are decoded.
+        if not value:
+            continue
+
+        if '%' in key:
+            key = urllib.parse.unquote(key)
 
-        version = int(version)
+        if '%' in value:
+            value = urllib.parse.unquote(value)
 
-    try:
-        compress = settings['compress'][0]
-    except SETTING_NOT_FOUND:
+        if key == 'v' and version is None:
+            version = value
+        elif key == 'compress' and compress is None:
+            compress = value
+        elif key == 'encoding' and encoding is None:
+            encoding = value
+
+    if version not in {'1'}:
+        return await ws.close(4001, 'Invalid API version')
+
+    if compress is None or compress == 'false':
         compress = False
+    elif compress == 'true':
+        compress = True
     else:
-        if compress == 'true':
-            compress = True
-        elif compress == 'false':
-            compress = False
-        else:
-            return await ws.close(4001, 'Invalid compress type')
-
-    try:
-        encoding = settings['encoding'][0]
-    except:
+        return await ws.close(4001, 'Invalid compress type')
+
+    if encoding not in {'json', 'msgpack'}:
         return await ws.close(4001, 'Invalid encoding type')
-    else:
-        if encoding not in ('json', 'msgpack'):
-            return await ws.close(4001, 'Invalid encoding type')
 
-    session = v1Session(version=version, encoding=encoding, compress=compress, ws=ws)
+    session = v1Session(
+        version=int(version), encoding=encoding, compress=compress, ws=ws
+    )
 
     # NOTE: This is a task which lasts until the connection drops.
     await session.run()
@@ -9,72 +9,59 @@ you may not use this file except in compliance with the Elastic License.
 from __future__ import annotations
 
 import asyncio
-import itertools
-from asyncio import Queue, sleep
-from typing import TYPE_CHECKING, TypedDict
+from asyncio import Queue, QueueFull, sleep
+from typing import TYPE_CHECKING, Iterable
 
 from aiokafka import AIOKafkaConsumer
+from msgspec import Raw
+from websockets import broadcast
 
-from gateway.database import Event, decode, get_hosts
+from gateway.database import Event, decode, encode_raw, get_hosts
 
 if TYPE_CHECKING:
     from .session import BaseSession
 
 
-class ManagedGuild(TypedDict):
-    id: int
-    sessions: list[int]
-
-
-class ManagedSession(TypedDict):
-    id: int
-    session: BaseSession | None
-
-
 class Registry:
     def __init__(self) -> None:
-        self._sessions: list[ManagedSession] = []
-        # manages the list of guilds managed by this registry
-        self._managed_guilds: list[ManagedGuild] = []
-        self._managed_guild_ids: list[int] = []
+        self._sessions_by_id: dict[str, BaseSession] = {}
+        # indexes of the sessions each guild and user event has to be dispatched to
+        self._guild_to_sessions: dict[int, set[BaseSession]] = {}
+        self._user_to_sessions: dict[int, set[BaseSession]] = {}
         self._queues: dict[str, Queue[Event]] = {}
         asyncio.create_task(self._manage_kafka())
 
-    async def append_queue(self, session_id: str, event: Event) -> None:
-        if not self._queues.get(session_id):
-            queue = Queue()
-            self._queues[session_id] = queue
-        else:
-            queue = self._queues[session_id]
-
-        await queue.put(event)
-
-    # TODO: use ws.broadcast for this.
-    async def handle_guild_id_event(self, event: Event) -> None:
-        for guild in self._managed_guilds:
-            if guild['id'] == event.guild_id:
-                for session_id, session in itertools.product(
-                    guild['sessions'], self._sessions
-                ):
-                    if session['id'] == session_id:
-                        assert not isinstance(session['session'], str)
-                        session2 = session['session']
-
-                        if session2.floodgates_open:
-                            await session2.send(event)
-                        else:
-                            await self.append_queue(
-                                session_id=session2.session_id, event=event
-                            )
-
-    async def handle_user_id_event(self, event: Event) -> None:
-        for session in self._sessions:
-            if session['session'].user_id == event.user_id:
-                if session['session'].floodgates_open:
-                    await session['session'].send(event)
-                else:
-                    await self.append_queue(session_id=session['id'], event=event)
-                break
+    def append_queue(self, session_id: str, event: Event) -> None:
+        if (queue := self._queues.get(session_id)) is None:
+            queue = self._queues[session_id] = Queue(maxsize=1024)
+
+        try:
+            queue.put_nowait(event)
+        except QueueFull:
+            # the session fell too far behind, keep memory bounded by dropping its
+            # oldest event instead of letting one busy guild grow the queue forever.
+            queue.get_nowait()
+            queue.put_nowait(event)
+
+    def _fan_out(
+        self, sessions: Iterable[BaseSession], event: Event, payloads: dict[str, Raw]
+    ) -> None:
+        for session in sessions:
+            if session.floodgates_open:
+                payload = payloads.get(session.encoding)
+
+                if payload is None:
+                    payload = payloads[session.encoding] = encode_raw(
+                        event.data, session.encoding
+                    )
+
+                # frames carry a per-session sequence number, so each session gets
+                # its own, and is compressed on its own when it's large enough. but
+                # broadcast writes it straight to the transport: a slow client can no
+                # longer stall the consumer.
+                broadcast((session._socket,), session.frame(event, payload=payload))
+            else:
+                self.append_queue(session_id=session.session_id, event=event)
 
     async def _manage_kafka(self) -> None:
         consumer = AIOKafkaConsumer(bootstrap_servers=get_hosts('KAFKA_HOSTS'))
@@ -96,45 +83,72 @@ class Registry:
             ]
         )
 
-        async for msg in consumer:
-            event = decode(msg)
-            if event.guild_id is not None:
-                await self.handle_guild_id_event(event=event)
+        while True:
+            # returns once records are buffered, the timeout only bounds idle polls
+            batches = await consumer.getmany(timeout_ms=100, max_records=500)
+
+            for messages in batches.values():
+                for msg in messages:
+                    self._dispatch(decode(msg.value))
+
+    def _dispatch(self, event: Event) -> None:
+        # the event data is the bulk of every frame, so it's only encoded once
+        # per encoding and spliced into each recipient's frame.
+        payloads: dict[str, Raw] = {}
+
+        if event.guild_id is not None:
+            self._fan_out(
+                self._guild_to_sessions.get(event.guild_id, ()), event, payloads
+            )
 
-            elif event.guild_ids is not None:
-                for guild_id in event.guild_ids:
-                    # TODO: There has to be a more memory efficient way to do this
-                    event = Event(event.name, event.data, guild_id=guild_id)
-                    await self.handle_guild_id_event(event)
+        elif event.guild_ids is not None:
+            for guild_id in event.guild_ids:
+                self._fan_out(
+                    self._guild_to_sessions.get(guild_id, ()), event, payloads
+                )
 
-            elif event.user_id is not None:
-                await self.handle_user_id_event(event=event)
+        elif event.user_id is not None:
+            self._fan_out(
+                self._user_to_sessions.get(event.user_id, ()), event, payloads
+            )
 
-            elif event.user_ids is not None:
-                for user_id in event.user_ids:
-                    # TODO: Same with the handling of guild_ids
-                    event = Event(event.name, event.data, user_id=user_id)
-                    await self.handle_user_id_event(event=event)
+        elif event.user_ids is not None:
+            for user_id in event.user_ids:
+                self._fan_out(self._user_to_sessions.get(user_id, ()), event, payloads)
 
     async def disconnect(self, session_id: str, reconnectable: bool):
-        for session in self._sessions:
-            if session['id'] == session_id:
-                session['session'] = None
-                break
+        session = self._sessions_by_id.get(session_id)
 
-        assert session
+        if session is None:
+            return
+
+        # anything dispatched while the session is gone is queued for it instead
+        session.floodgates_open = False
 
         if reconnectable:
             await sleep(60)
 
-            for session in self._sessions:
-                if session['id'] == session_id:
-                    if session['session'] is None:
-                        return
-                    session = session
-                    break
+            # it was either resumed or already torn down by another disconnect
+            if self._sessions_by_id.get(session_id) is not session:
+                return
+
+        del self._sessions_by_id[session_id]
+        self._queues.pop(session_id, None)
+
+        for guild_id in session.guild_ids:
+            self._unindex(self._guild_to_sessions, guild_id, session)
+
+        self._unindex(self._user_to_sessions, session.user_id, session)
+
+    def _unindex(
+        self, index: dict[int, set[BaseSession]], key: int, session: BaseSession
+    ) -> None:
+        sessions = index.get(key)
+
+        if sessions is None:
+            return
 
-        self._sessions.pop(session)
+        sessions.discard(session)
 
-        if self._queues.get(session_id):
-            self._queues.pop(session_id)
+        if not sessions:
+            del index[key]
@@ -7,10 +7,10 @@ you may not use this file except in compliance with the Elastic License.
 """
 from __future__ import annotations
 
-import hashlib
-import os
-from typing import TYPE_CHECKING, Any, Literal
+import secrets
+from typing import TYPE_CHECKING, Literal
 
+import msgspec
 from websockets.server import WebSocketServerProtocol
 
 from gateway.database import Event
@@ -23,7 +23,6 @@ if TYPE_CHECKING:
 # NOTE: private functions, and version-specific functions are not listed here because
 # this is only meant for the registry to read, and sometimes write.
 class BaseSession:
-    _compressor: Any | None
     _socket: WebSocketServerProtocol
     _sequence: int
     guild_ids: list[int]
@@ -42,9 +41,15 @@ class BaseSession:
         encoding: Literal['json', 'msgpack'],
         compress: bool,
         ws: WebSocketServerProtocol,
+        compress_threshold: int = 512,
     ) -> None:
         pass
 
+    def frame(
+        self, data: dict | Event, payload: msgspec.Raw | None = None
+    ) -> bytes | str:
+        pass
+
     async def send(self, data: dict | Event) -> None:
         pass
 
@@ -55,17 +60,13 @@ class BaseSession:
         pass
 
     def _create_session_id(self) -> str:
-        return hashlib.sha1(os.urandom(128)).hexdigest()
+        return secrets.token_hex(20)
 
     def _equip(self, reg: Registry) -> None:
         self._registry = reg
-        self.session_id = self._create_session_id()
-        reg._sessions.append({'id': self.session_id, 'session': self})
+        reg._sessions_by_id[self.session_id] = self
+        reg._user_to_sessions.setdefault(self.user_id, set()).add(self)
 
     def _equip_guilds(self):
         for guild_id in self.guild_ids:
-            if guild_id not in self._registry._managed_guild_ids:
-                self._registry._managed_guild_ids.append(guild_id)
-                self._registry._managed_guilds.append(
-                    {'id': guild_id, 'sessions': [self]}
-                )
+            self._registry._guild_to_sessions.setdefault(guild_id, set()).add(self)
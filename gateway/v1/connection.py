@@ -8,54 +8,99 @@ you may not use this file except in compliance with the Elastic License.
 import asyncio
 import base64
 import binascii
+import itertools
 import traceback
-import zlib
-from asyncio import Task
 from typing import Any, Coroutine, Literal, Sequence
 
 import itsdangerous
 import msgspec
 import websockets.exceptions
-from pydantic import ValidationError
 from websockets.server import WebSocketServerProtocol
 
 from gateway.database import (
+    ENCODERS,
     Activity,
-    CategoryChannel,
     Channel,
     DMChannel,
     Event,
-    Feature,
     GatewaySessionLimit,
     GroupDMChannel,
-    Guild,
-    Member,
+    NotApplied,
     NotFound,
     Presence,
     ReadState,
     Recipient,
     Relationship,
-    Role,
     Settings,
-    TextChannel,
     User,
-    WSMessage,
-    encode,
-    objectify,
+    cql_exec,
+    to_struct,
+    zstd_compress,
 )
 from gateway.registry import Registry
 from gateway.session import BaseSession
 
-from .models import Identify, Intents
+from .models import (
+    ActivityOut,
+    Dispatch,
+    DMChannelOut,
+    GuildChannelOut,
+    GuildOut,
+    Identify,
+    Intents,
+    PresenceOut,
+    ReadStateOut,
+    RecipientOut,
+    RelationshipOut,
+    RoleOut,
+    SettingsOut,
+    UserOut,
+    WSMessage,
+)
+
+# ops clients can send, with the handler and payload type of each
+OPCODES: dict[int, tuple[str, type[msgspec.Struct]]] = {2: ('identify', Identify)}
+# a list of sequenced dispatches, for clients which identified with bulk_dispatch
+BULK_DISPATCH_OP = 3
+REGISTRY: Registry | None = None
+# how often a claim is retried when concurrent identifies keep changing the count
+CONNECTION_CLAIM_ATTEMPTS = 5
+CLIENT_STATUSES = {
+    'Discend Mobile': 'mobile',
+    'Discend Web': 'web',
+    'Discend Desktop': 'desktop',
+}
+# every character a token can hold: both base64 alphabets, padding and separators
+TOKEN_CHARACTERS = (
+    b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/-_=.'
+)
+WS_DECODERS: dict[str, msgspec.json.Decoder | msgspec.msgpack.Decoder] = {
+    'json': msgspec.json.Decoder(WSMessage),
+    'msgpack': msgspec.msgpack.Decoder(WSMessage),
+}
+PAYLOAD_DECODERS: dict[
+    str, dict[int, msgspec.json.Decoder | msgspec.msgpack.Decoder]
+] = {
+    'json': {op: msgspec.json.Decoder(t) for op, (_, t) in OPCODES.items()},
+    'msgpack': {op: msgspec.msgpack.Decoder(t) for op, (_, t) in OPCODES.items()},
+}
 
 
-def yield_chunks(input_list: Sequence[Any], chunk_size: int):
-    for idx in range(0, len(input_list), chunk_size):
-        yield input_list[idx : idx + chunk_size]
+# tokens are `base64(user id).timestamp.signature`. malformed ones are turned away
+# here, before they cost an executor hop, a query and an HMAC.
+def token_user_id(token: str) -> int | None:
+    if len(token) > 256:
+        return None
 
+    raw = token.encode()
 
-OPCODES = {2: 'identify'}
-REGISTRY: Registry | None = None
+    if raw.count(b'.') != 2 or raw.translate(None, TOKEN_CHARACTERS):
+        return None
+
+    try:
+        return int(base64.b64decode(raw.partition(b'.')[0], validate=True))
+    except (ValueError, binascii.Error):
+        return None
 
 
 class v1Session(BaseSession):
@@ -65,233 +110,304 @@ class v1Session(BaseSession):
         encoding: Literal['json', 'msgpack'],
         compress: bool,
         ws: WebSocketServerProtocol,
+        compress_threshold: int = 512,
     ) -> None:
         global REGISTRY
         self.version = version
         self.encoding = encoding
+        self._encoder = ENCODERS[encoding]
         self.compress = compress
+        # smaller frames barely shrink, and aren't worth the compressor's time
+        self.compress_threshold = compress_threshold
         # self.interval = randint(40, 46) * 1000
         self._socket = ws
         self._sequence = 0
         self.identified: bool = False
+        # whether identify took a connection and set the presence, which then has to
+        # be cleared however the session ends
+        self.claimed: bool = False
+        self.floodgates_open = False
+        self.session_id = self._create_session_id()
         # TODO: let this be special for big bots
         self._rate_limit: int = 60
         self.loop = asyncio.get_running_loop()
-        self._compressor = None
         self.disconnected: bool = False
 
-        if compress:
-            self._compressor = zlib.compressobj()
-
         if REGISTRY is None:
             REGISTRY = Registry()
 
         self._registry = REGISTRY
 
+    def _envelope(
+        self,
+        data: dict | list | Event,
+        op: int,
+        add_essentials: bool,
+        payload: msgspec.Raw | None = None,
+    ) -> Dispatch:
+        # an already encoded copy of `d`, shared between the recipients of a dispatch
+        if payload is None:
+            payload = data.data if isinstance(data, Event) else data
+
+        if not add_essentials:
+            return Dispatch(op=op, d=payload)
+
+        self._sequence += 1
+        return Dispatch(op=op, t=data.name, s=self._sequence, d=payload)
+
+    def frame(
+        self,
+        data: dict | list | Event,
+        op: int = 0,
+        add_essentials: bool = True,
+        payload: msgspec.Raw | None = None,
+    ) -> bytes | str:
+        new_data = self._envelope(data, op, add_essentials, payload)
+        frame = self._encoder.encode(new_data)
+
+        # compressed frames can be told apart by zstd's magic number, msgpack
+        # frames are always maps and so can never start with it.
+        # the whole frame is compressed, sequence included, so every compressed
+        # recipient of a dispatch costs a compress of its own. only the encoded `d`
+        # is shared, zstd is just a cheaper codec than zlib, with no per-session state.
+        if self.compress and len(frame) >= self.compress_threshold:
+            return zstd_compress(frame)
+
+        # json clients read text frames, everything else goes out as binary
+        if self.encoding == 'json':
+            return frame.decode()
+
+        return frame
+
     async def send(
-        self, data: dict | Event, op: int = 0, add_essentials: bool = True
+        self, data: dict | list | Event, op: int = 0, add_essentials: bool = True
     ) -> None:
-        new_data = {'op': op}
+        await self._socket.send(self.frame(data, op, add_essentials))
+
+    async def send_bulk(self, events: Sequence[Event]) -> None:
+        if not self.identify.bulk_dispatch:
+            await asyncio.gather(*(self.send(event) for event in events))
+            return
+
+        # one frame instead of one per event, each event keeps its own sequence
+        dispatches: list[dict[str, Any]] = []
 
-        if add_essentials:
+        for event in events:
             self._sequence += 1
-            new_data['t'] = data.name
-            new_data['s'] = self._sequence
-
-        new_data['d'] = data.data if isinstance(data, Event) else data
-
-        if self.compress is True:
-            await self._socket.send(
-                yield_chunks(
-                    input_size=encode(
-                        data=new_data,
-                        compressor=self._compressor,
-                        encoding=self.encoding,
-                    ),
-                    chunk_size=1024,
-                )
-            )
-        else:
-            await self._socket.send(encode(new_data, None, encoding=self.encoding))
+            dispatches.append({'t': event.name, 's': self._sequence, 'd': event.data})
+
+        await self.send(dispatches, BULK_DISPATCH_OP, add_essentials=False)
 
     async def close(self, code: int, reason: str, reconnectable: bool):
         await self._socket.close(code=code, reason=reason)
         await self._registry.disconnect(self.session_id, reconnectable)
 
-    def _validate_token(self, token: str) -> Task | User:
-        fragmented = token.split('.')
-        user_id = fragmented[0]
-
-        try:
-            user_id = base64.b64decode(user_id.encode())
-            user_id = int(user_id)
-        except (ValueError, binascii.Error):
-            return asyncio.create_task(self.close(4005, 'Invalid token', False))
-
+    # runs on an executor thread, so it only reports the outcome and leaves
+    # closing the connection to the loop.
+    def _validate_token(self, token: str, user_id: int) -> User | None:
+        # the whole row is read up front, so a valid token costs one round trip
         try:
-            user: User = User.objects(User.id == user_id).only(['password']).get()
-        except:
-            return asyncio.create_task(self.close(4005, 'Invalid token', False))
+            user: User = User.objects(User.id == user_id).get()
+        except NotFound:
+            return None
 
         signer = itsdangerous.TimestampSigner(user.password)
 
         try:
             signer.unsign(token)
-
-            return User.objects(User.id == user_id).get()
         except (itsdangerous.BadSignature):
-            return asyncio.create_task(self.close(4005, 'Invalid token', False))
+            return None
 
-    async def validate_token(self, token: str) -> bool | User:
-        result = await self.loop.run_in_executor(None, self._validate_token, token)
+        return user
 
-        if not isinstance(result, Task):
-            return result
+    async def validate_token(self, token: str) -> User | None:
+        user_id = token_user_id(token)
 
-        await result
-        return False
+        if user_id is None:
+            user = None
+        else:
+            user = await self.loop.run_in_executor(
+                None, self._validate_token, token, user_id
+            )
 
-    def _decrease_connection_count(self) -> bool:
-        # sourcery skip: simplify-numeric-comparison
+        if user is None:
+            await self.close(4005, 'Invalid token', False)
+
+        return user
+
+    def _get_remaining_connections(self) -> int:
         try:
-            gwsl: GatewaySessionLimit = GatewaySessionLimit.objects(
-                GatewaySessionLimit.user_id == self.user_id
-            ).get()
+            return (
+                GatewaySessionLimit.objects(GatewaySessionLimit.user_id == self.user_id)
+                .get()
+                .remaining
+            )
         except NotFound:
-            gwsl: GatewaySessionLimit = GatewaySessionLimit.create(user_id=self.user_id)
+            pass
 
-        if (gwsl.remaining - 1) < 0:
-            return False
+        try:
+            return (
+                GatewaySessionLimit.if_not_exists()
+                .create(user_id=self.user_id)
+                .remaining
+            )
+        except NotApplied as exc:
+            # another identify created it first
+            return exc.existing['remaining']
 
-        gwsl.update(remaining=gwsl.remaining - 1)
-        return True
+    # None when the count kept changing underneath every attempt
+    def _decrease_connection_count(self) -> bool | None:
+        remaining = self._get_remaining_connections()
 
-    async def decrease_connection_count(self) -> bool:
-        return await self.loop.run_in_executor(None, self._decrease_connection_count)
+        # every write is conditional on the count it replaces, so concurrent identifies
+        # of the same user can't both take the last connection. a lost race retries
+        # with the count that beat it, which the failed write returns.
+        for _ in range(CONNECTION_CLAIM_ATTEMPTS):
+            if remaining <= 0:
+                return False
 
-    def _get_joined_guild_ids(self) -> list[int]:
-        member_guild_ids: list[Member] = (
-            Member.objects(Member.user_id == self.user_id).only(['guild_id']).all()
-        )
+            try:
+                GatewaySessionLimit.objects(
+                    GatewaySessionLimit.user_id == self.user_id
+                ).iff(remaining=remaining).update(remaining=remaining - 1)
+            except NotApplied as exc:
+                remaining = exc.existing.get('remaining')
+
+                # the row expired in between, so the day's limit starts over
+                if remaining is None:
+                    remaining = self._get_remaining_connections()
+
+                continue
+
+            return True
+
+        return None
+
+    # everything identify writes through cqlengine, done in one executor job
+    def _claim_connection(self) -> bool | None:
+        if not (decreased := self._decrease_connection_count()):
+            return decreased
+
+        self._set_presence()
+        return True
 
-        return [obj.guild_id for obj in member_guild_ids]
+    async def claim_connection(self) -> bool | None:
+        return await self.loop.run_in_executor(None, self._claim_connection)
 
     async def get_joined_guild_ids(self) -> list[int]:
-        return await self.loop.run_in_executor(None, self._get_joined_guild_ids)
+        rows = await cql_exec('joined_guild_ids', self.user_id)
+        return [row['guild_id'] for row in rows]
 
-    def _get_guild_channels(self, guild_id: int) -> list[dict]:
-        category_channels: list[CategoryChannel] = CategoryChannel.objects(
-            CategoryChannel.guild_id == guild_id
-        ).all()
-        text_channels: list[TextChannel] = TextChannel.objects(
-            TextChannel.guild_id == guild_id
-        ).all()
+    async def get_guild_channels(self, guild_id: int) -> list[GuildChannelOut]:
+        category_channels, text_channels = await asyncio.gather(
+            cql_exec('categories', guild_id), cql_exec('text_channels', guild_id)
+        )
 
         # TODO: permission overwrites
-        dict_category_channels: list[dict] = [
-            objectify(dict(channel)) for channel in category_channels
-        ]
-        dict_text_channels: list[dict] = [
-            objectify(dict(channel)) for channel in text_channels
+        return [
+            to_struct(channel, GuildChannelOut)
+            for channel in itertools.chain(category_channels, text_channels)
         ]
 
-        return dict_category_channels + dict_text_channels
+    async def get_guilds(self) -> list[GuildOut]:
+        if not self.guild_ids:
+            return []
 
-    def _get_guild_roles(self, guild_id: int) -> list[dict]:
-        return [
-            objectify(dict(role))
-            for role in Role.objects(Role.guild_id == guild_id).all()
-        ]
+        rows, roles, features, *channels = await asyncio.gather(
+            cql_exec('guilds', self.guild_ids),
+            cql_exec('roles', self.guild_ids),
+            cql_exec('features', self.guild_ids),
+            *(self.get_guild_channels(guild_id) for guild_id in self.guild_ids),
+        )
+        channels_by_guild = dict(zip(self.guild_ids, channels))
+        roles_by_guild: dict[int, list[RoleOut]] = {}
+        features_by_guild: dict[int, list[str]] = {}
 
-    def _get_guild_features(self, guild_id: int) -> list[str]:
-        return [
-            feature.value
-            for feature in Feature.objects(Feature.guild_id == guild_id)
-            .only(['value'])
-            .all()
-        ]
+        for role in roles:
+            roles_by_guild.setdefault(role['guild_id'], []).append(
+                to_struct(role, RoleOut)
+            )
 
-    def _get_joined_guilds(self, guild_ids: list[int]) -> list[Task]:
-        tasks: list[Task] = []
+        for feature in features:
+            features_by_guild.setdefault(feature['guild_id'], []).append(
+                feature['value']
+            )
 
-        for guild_id in guild_ids:
-            guild: dict = objectify(dict(Guild.objects(Guild.id == guild_id).get()))
-            channels = self._get_guild_channels(guild_id=guild_id)
-            roles = self._get_guild_roles(guild_id=guild_id)
+        # memberships which outlived their guild have no row, and are left out
+        guilds = [to_struct(row, GuildOut) for row in rows]
 
-            guild['channels'] = channels
-            guild['roles'] = roles
-            guild['features'] = self._get_guild_features(guild_id=guild_id)
-            tasks.append(self.send(Event('GUILD_CREATE', guild)))
+        for guild in guilds:
+            guild.channels = channels_by_guild.get(guild.id, [])
+            guild.roles = roles_by_guild.get(guild.id, [])
+            guild.features = features_by_guild.get(guild.id, [])
 
-        return tasks
+        return guilds
 
     async def send_guilds(self) -> None:
-        tasks = await self.loop.run_in_executor(
-            None, self._get_joined_guilds, self.guild_ids
-        )
+        guilds = await self.get_guilds()
         # Spam the user all at once when guild processing is done
-        await asyncio.gather(*tasks)
+        await self.send_bulk([Event('GUILD_CREATE', guild) for guild in guilds])
 
     async def empty_queue(self) -> None:
-        queue = self._registry._queues.get(self.session_id)
+        queues = self._registry._queues
 
-        if queue is None:
-            return
-        elif queue.empty():
-            return
+        # events are still queued while earlier ones are being sent, so the queue is
+        # drained until it stays empty. each pass is taken in one go, and sent as a
+        # single bulk dispatch when the client can take one.
+        while (queue := queues.get(self.session_id)) is not None and not queue.empty():
+            await self.send_bulk([queue.get_nowait() for _ in range(queue.qsize())])
 
-        for _ in range(queue.qsize() - 1):
-            event = await queue.get()
-            await self.send(event)
+        # nothing awaits between the last drain and here, so no event can be
+        # stranded in the queue, or overtake a queued one.
+        self.floodgates_open = True
+        queues.pop(self.session_id, None)
 
-    def _get_relationships(self) -> tuple[list[dict], list[dict]]:
-        rels: list[Relationship] = Relationship.objects(
-            Relationship.user_id == self.user_id
-        ).all()
+    def _get_relationships(
+        self,
+    ) -> tuple[list[RelationshipOut], list[PresenceOut]]:
+        rels: list[Relationship] = list(
+            Relationship.objects(Relationship.user_id == self.user_id).all()
+        )
 
-        ret: list[dict] = []
-        ret_friend_presences: list[dict] = []
+        ret: list[RelationshipOut] = []
+        ret_friend_presences: list[PresenceOut] = []
 
-        for rel in rels:
-            reld = dict(rel)
-            reld.pop('user_id')
-            target_id = reld.pop('target_id')
-            reld['user'] = (
-                User.objects(User.id == target_id).defer(['password', 'email']).get()
-            )
+        if not rels:
+            return ret, ret_friend_presences
 
-            ret.append(reld)
-            if rel.type == 0:
-                try:
-                    presence: Presence = Presence.objects(
-                        Presence.user_id == target_id
-                    ).get()
-                except NotFound:
-                    continue
+        # one IN query per table, instead of a round trip per relationship
+        target_ids = [rel.target_id for rel in rels]
+        friend_ids = [rel.target_id for rel in rels if rel.type == 0]
+        users: dict[int, UserOut] = {
+            user.id: to_struct(user, UserOut)
+            for user in User.objects(User.id.in_(target_ids))
+            .defer(['password', 'email'])
+            .all()
+        }
+        presences: dict[int, PresenceOut] = {}
+        activities: dict[int, list[ActivityOut]] = {}
 
-                _activities: list[Activity] = Activity.objects(
-                    Activity.user_id == target_id
-                ).all()
+        if friend_ids:
+            for presence in Presence.objects(Presence.user_id.in_(friend_ids)).all():
+                presences[presence.user_id] = to_struct(presence, PresenceOut)
 
-                activities = [dict(activity) for activity in _activities]
-                presd = dict(presence)
-                presd['activities'] = activities
-                ret_friend_presences.append(presd)
+            for activity in Activity.objects(Activity.user_id.in_(friend_ids)).all():
+                activities.setdefault(activity.user_id, []).append(
+                    to_struct(activity, ActivityOut)
+                )
 
-        return ret, ret_friend_presences
+        for rel in rels:
+            # the target's account is gone
+            if (user := users.get(rel.target_id)) is None:
+                continue
 
-    def _get_client_status(self) -> str:
-        dev = self.identify.properties.device
+            ret.append(RelationshipOut(type=rel.type, user=user))
 
-        if dev == 'Discend Mobile':
-            return 'mobile'
-        elif dev == 'Discend Web':
-            return 'web'
-        elif dev == 'Discend Desktop':
-            return 'desktop'
-        else:
-            return 'unknown'
+            if rel.type == 0 and (presence := presences.get(rel.target_id)) is not None:
+                presence.activities = activities.get(rel.target_id, [])
+                ret_friend_presences.append(presence)
+
+        return ret, ret_friend_presences
 
     def _set_presence(self) -> None:
         setting: Settings = (
@@ -306,15 +422,12 @@ class v1Session(BaseSession):
             Presence.create(
                 user_id=self.user_id,
                 status=setting.status or 'online',
-                client_status=self._get_client_status(),
+                client_status=self.client_status,
             )
         else:
             if presence.status == 'invisible' and setting.status != 'invisible':
                 presence.update(status=setting.status)
 
-    async def set_presence(self) -> None:
-        await self.loop.run_in_executor(None, self._set_presence)
-
     def _delete_presence(self) -> None:
         setting: Settings = (
             Settings.objects(Settings.user_id == self.user_id).only(['status']).get()
@@ -323,69 +436,124 @@ class v1Session(BaseSession):
         if setting.status == 'invisible':
             return
 
-        presence: Presence = Presence.objects(Presence.user_id == self.user_id).get()
+        try:
+            presence: Presence = Presence.objects(
+                Presence.user_id == self.user_id
+            ).get()
+        except NotFound:
+            return
+
         presence.update(status='invisible')
 
     async def delete_presence(self) -> None:
         await self.loop.run_in_executor(None, self._delete_presence)
 
-    async def get_relationships(self) -> tuple[list[dict], list[dict]]:
+    async def get_relationships(
+        self,
+    ) -> tuple[list[RelationshipOut], list[PresenceOut]]:
         return await self.loop.run_in_executor(None, self._get_relationships)
 
-    def _get_user_channels(self) -> tuple[list[dict], list[dict]]:
+    def _get_user_channels(self) -> tuple[list[DMChannelOut], list[DMChannelOut]]:
         ret_normal = []
         ret_group = []
-        recp: list[Recipient] = Recipient.objects(
-            Recipient.user_id == self.user_id
-        ).all()
-
-        for recipient in recp:
-            channel: Channel = Channel.objects(Channel.id == recipient.channel_id).get()
-            recipients = [
-                objectify(dict(r))
-                for r in Recipient.objects(Recipient.channel_id).all()
-                if r.user_id != recipient.user_id
-            ]
+        channel_ids = [
+            recipient.channel_id
+            for recipient in Recipient.objects(Recipient.user_id == self.user_id).all()
+        ]
 
-            if channel.type == 1:
-                chn = (
-                    dict(DMChannel.objects(DMChannel.channel_id == channel.id).get())
-                    | channel
-                )
-                chn['recipients'] = recipients
-                ret_normal.append(objectify(chn, True))
-            elif channel.type == 2:
-                chn = (
-                    dict(
-                        GroupDMChannel.objects(
-                            GroupDMChannel.channel_id == channel.id
-                        ).get()
-                    )
-                    | channel
+        if not channel_ids:
+            return ret_normal, ret_group
+
+        # every table is read once with IN, rather than once per channel
+        channels: dict[int, Channel] = {
+            channel.id: channel
+            for channel in Channel.objects(Channel.id.in_(channel_ids)).all()
+        }
+        recipients: dict[int, list[RecipientOut]] = {}
+
+        for r in Recipient.objects(Recipient.channel_id.in_(channel_ids)).all():
+            if r.user_id != self.user_id:
+                recipients.setdefault(r.channel_id, []).append(
+                    to_struct(r, RecipientOut)
                 )
-                chn['recipients'] = recipients
-                ret_group.append(objectify(chn, True))
+
+        dm_ids = [cid for cid, channel in channels.items() if channel.type == 1]
+        group_ids = [cid for cid, channel in channels.items() if channel.type == 2]
+        dms: dict[int, DMChannel] = {}
+
+        if dm_ids:
+            for dm in DMChannel.objects(DMChannel.channel_id.in_(dm_ids)).all():
+                dms[dm.channel_id] = dm
+
+        if group_ids:
+            for dm in GroupDMChannel.objects(
+                GroupDMChannel.channel_id.in_(group_ids)
+            ).all():
+                dms[dm.channel_id] = dm
+
+        for channel_id, channel in channels.items():
+            if (dm := dms.get(channel_id)) is None:
+                continue
+
+            chn = (
+                dict(dm)
+                | dict(channel)
+                | {'recipients': recipients.get(channel_id, [])}
+            )
+
+            if channel.type == 1:
+                ret_normal.append(to_struct(chn, DMChannelOut))
+            else:
+                ret_group.append(to_struct(chn, DMChannelOut))
 
         return ret_normal, ret_group
 
-    async def get_user_channels(self) -> tuple[list[dict], list[dict]]:
+    async def get_user_channels(
+        self,
+    ) -> tuple[list[DMChannelOut], list[DMChannelOut]]:
         return await self.loop.run_in_executor(None, self._get_user_channels)
 
+    def _get_read_states(self) -> list[ReadStateOut]:
+        return [
+            to_struct(readstate, ReadStateOut)
+            for readstate in ReadState.objects(ReadState.user_id == self.user_id).all()
+        ]
+
+    async def get_read_states(self) -> list[ReadStateOut]:
+        return await self.loop.run_in_executor(None, self._get_read_states)
+
+    def _get_settings(self) -> SettingsOut:
+        return to_struct(
+            Settings.objects(Settings.user_id == self.user_id)
+            .defer(['mfa_code'])
+            .get(),
+            SettingsOut,
+        )
+
+    async def get_settings(self) -> SettingsOut:
+        return await self.loop.run_in_executor(None, self._get_settings)
+
     async def send_ready(self) -> None:
-        _readstates = ReadState.objects(ReadState.user_id == self.user_id).all()
-        readstates: dict[str, Any] = [dict(readstate) for readstate in _readstates]
-        settings = (
-            Settings.objects(Settings.user_id == self.user_id).defer(['mfa_code']).get()
+        # none of these depend on each other, so they're read at the same time
+        (
+            readstates,
+            settings,
+            (relationships, friend_presences),
+            (user_dms, group_dms),
+        ) = await asyncio.gather(
+            self.get_read_states(),
+            self.get_settings(),
+            self.get_relationships(),
+            self.get_user_channels(),
         )
 
-        relationships, friend_presences = await self.get_relationships()
-        user_dms, group_dms = await self.get_user_channels()
         self._equip(reg=self._registry)
+        self._equip_guilds()
         await self.send(
             Event(
                 'READY',
                 {
-                    'settings': dict(settings),
+                    'settings': settings,
                     'read_states': readstates,
                     'relationships': relationships,
                     'friend_presences': friend_presences,
@@ -395,41 +563,43 @@ class v1Session(BaseSession):
             )
         )
 
-    async def on_identify(self, data: dict[str, Any]):
+    async def on_identify(self, identify: Identify):
         if self.identified:
             return await self.close(4007, 'You have already identified', True)
 
-        try:
-            # TODO: track analytics data stored here
-            identify = Identify.validate(data)
-        except ValidationError:
-            await self._socket.close(4004, 'Invalid data sent')
-            await self._registry.disconnect(self.session_id, reconnectable=False)
-            return
-
+        # TODO: track analytics data stored here
         self.identify = identify
+        self.client_status = CLIENT_STATUSES.get(identify.properties.device, 'unknown')
 
         self.intents = Intents(identify.intents)
-        is_valid = await self.validate_token(identify.token)
+        user = await self.validate_token(identify.token)
 
-        if not is_valid:
-            # TODO: cleanups
+        # the connection was already closed
+        if user is None:
             return
 
         self.token = identify.token
-        self.user_id = is_valid.id
-        decreased_connection_count = await self.decrease_connection_count()
+        self.user_id = user.id
+        # guild ids are read on the loop, so they're fetched while the executor works
+        claimed, self.guild_ids = await asyncio.gather(
+            self.claim_connection(), self.get_joined_guild_ids()
+        )
+
+        self.claimed = claimed is True
 
-        if not decreased_connection_count:
+        if claimed is None:
+            return await self.close(
+                4008, 'Too many concurrent identifies, please reconnect', False
+            )
+        elif not claimed:
             return await self.close(
                 4006, 'You have reached your connection limit for today', False
             )
 
-        self.guild_ids = await self.get_joined_guild_ids()
         await self.send_ready()
         await self.send_guilds()
         await self.empty_queue()
-        self.floodgates_open = True
+        self.identified = True
 
     def _model_to_dict(self, model: Event):
         return {
@@ -446,22 +616,29 @@ class v1Session(BaseSession):
 
     async def handle_events(self):
         async for msg in self._socket:
+            # text frames can only be json, binary ones are in the session's encoding.
+            # msgspec reads both str and bytes, so neither is copied.
+            encoding = 'json' if isinstance(msg, str) else self.encoding
+
             try:
-                data = msgspec.json.decode(msg.encode(), type=WSMessage)
+                message: WSMessage = WS_DECODERS[encoding].decode(msg)
             except msgspec.DecodeError:
-                await self._socket.close(4002, 'Invalid json object')
-                await self._registry.disconnect(self.session_id, reconnectable=False)
+                await self.close(4002, 'Invalid payload', False)
                 break
 
+            if message.op not in OPCODES:
+                await self.close(4003, 'Invalid OP code', False)
+                break
+
+            # a missing `d` is empty, which fails here too
             try:
-                stringified_op = OPCODES[data.op]
-            except KeyError:
-                await self._socket.close(4003, 'Invalid OP code')
-                await self._registry.disconnect(self.session_id, reconnectable=False)
+                data = PAYLOAD_DECODERS[encoding][message.op].decode(message.d)
+            except msgspec.DecodeError:
+                await self.close(4004, 'Invalid data sent', False)
                 break
 
-            handler: Coroutine = getattr(self, f'on_{stringified_op}')
-            await handler(data.d)
+            handler: Coroutine = getattr(self, f'on_{OPCODES[message.op][0]}')
+            await handler(data)
 
     async def run(self) -> None:
         try:
@@ -474,6 +651,9 @@ class v1Session(BaseSession):
             traceback.print_exception(exc)
             await self.close(4000, 'Unknown exception occured, please reconnect.', True)
         finally:
-            if self.identified:
+            if self.claimed:
                 await self.delete_presence()
-                await self._registry.disconnect(self.session_id, True)
+
+            # sessions are indexed from READY onwards, so one dropped partway through
+            # identify has to be torn down too. only identified ones can be resumed.
+            await self._registry.disconnect(self.session_id, self.identified)
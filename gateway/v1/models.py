@@ -5,38 +5,185 @@ Copyright Discend and/or licensed to Discend under one
 or more contributor license agreements. Licensed under the Elastic License;
 you may not use this file except in compliance with the Elastic License.
 """
-import functools
-from typing import Literal
+from datetime import datetime
+from typing import Any, Literal
 
-from pydantic import BaseModel
+import msgspec
+from msgspec import UNSET, UnsetType
 
+from gateway.database import BigInt
 
-def flagged(value: int, visible: int) -> bool:
-    return bool(value & visible)
 
-
-class ConnectionProperties(BaseModel):
+class ConnectionProperties(msgspec.Struct, frozen=True, kw_only=True):
     os: Literal['linux', 'darwin', 'windows']
     browser: str
-    browser_user_agent: str | None
-    client_build_number: int | None
-    client_version: str | None
+    browser_user_agent: str | None = None
+    client_build_number: int | None = None
+    client_version: str | None = None
     device: str
-    distro: str | None
-    os_arch: str | None
-    os_version: str | None
-    referrer: str | None
-    referring_domain: str | None
-    release_channel: Literal['stable', 'canary', 'devel'] | None
-    window_manager: str | None
+    distro: str | None = None
+    os_arch: str | None = None
+    os_version: str | None = None
+    referrer: str | None = None
+    referring_domain: str | None = None
+    release_channel: Literal['stable', 'canary', 'devel'] | None = None
+    window_manager: str | None = None
 
 
-class Identify(BaseModel):
+class Identify(msgspec.Struct, frozen=True):
     token: str
     intents: int
     properties: ConnectionProperties
+    # whether the client reads op 3, which packs many dispatches into one frame
+    bulk_dispatch: bool = False
+
+
+# the envelope of every frame clients send. `d` is left encoded until `op` has been
+# checked, then decoded straight into that op's payload type. it can't be part of
+# a reference cycle, so it is kept out of the GC. array_like isn't used, clients
+# send maps.
+class WSMessage(msgspec.Struct, frozen=True, gc=False):
+    op: int | None = None
+    d: msgspec.Raw = msgspec.Raw()
+
+
+# the envelope of every frame sent to clients. t and s are only set on dispatches.
+class Dispatch(msgspec.Struct, kw_only=True, omit_defaults=True, gc=False):
+    op: int
+    t: str | UnsetType = UNSET
+    s: int | UnsetType = UNSET
+    d: Any
 
 
 class Intents:
+    __slots__ = ('value',)
+
     def __init__(self, intents: int) -> None:
-        self.get = functools.partial(flagged, intents)
+        self.value = intents
+
+    def get(self, intent: int) -> bool:
+        return self.value & intent != 0
+
+    # whether every bit of mask is set, so several intents are checked with one AND
+    def has(self, mask: int) -> bool:
+        return self.value & mask == mask
+
+
+class GuildChannelOut(msgspec.Struct, omit_defaults=True):
+    channel_id: BigInt
+    guild_id: BigInt | None
+    position: int | None
+    parent_id: BigInt | None
+    nsfw: bool | None
+    # only set on text channels
+    rate_limit_per_user: int | None | UnsetType = UNSET
+    topic: str | None | UnsetType = UNSET
+    last_message_id: BigInt | None | UnsetType = UNSET
+
+
+class RoleOut(msgspec.Struct):
+    id: BigInt
+    guild_id: BigInt
+    name: str | None
+    color: int | None
+    viewable: bool | None
+    icon: str | None
+    unicode_emoji: str | None
+    position: int | None
+    permissions: BigInt | None
+    mentionable: bool | None
+
+
+class GuildOut(msgspec.Struct):
+    id: BigInt
+    name: str | None
+    icon: str | None
+    splash: str | None
+    discovery_splash: str | None
+    owner_id: BigInt | None
+    default_permissions: BigInt | None
+    afk_channel_id: BigInt | None
+    afk_timeout: int | None
+    default_message_notification_level: int | None
+    explicit_content_filter: int | None
+    mfa_level: int | None
+    system_channel_id: BigInt | None
+    system_channel_flags: int | None
+    rules_channel_id: BigInt | None
+    max_presences: int | None
+    max_members: int | None
+    vanity_url_code: str | None
+    description: str | None
+    banner: str | None
+    preferred_locale: str | None
+    guild_updates_channel_id: BigInt | None
+    nsfw_level: int | None
+    verification_level: int | None
+    channels: list[GuildChannelOut] = []
+    roles: list[RoleOut] = []
+    features: list[str] = []
+
+
+class RecipientOut(msgspec.Struct):
+    channel_id: BigInt
+    user_id: BigInt
+
+
+class DMChannelOut(msgspec.Struct, omit_defaults=True):
+    id: BigInt
+    type: int
+    name: str | None
+    last_message_id: BigInt | None
+    recipients: list[RecipientOut]
+    # only set on group dms
+    icon: str | None | UnsetType = UNSET
+    owner_id: BigInt | None | UnsetType = UNSET
+
+
+class UserOut(msgspec.Struct):
+    id: BigInt
+    username: str | None
+    discriminator: str | None
+    avatar: str | None
+    banner: str | None
+    flags: int | None
+    bot: bool | None
+    verified: bool | None
+
+
+class RelationshipOut(msgspec.Struct):
+    type: int | None
+    user: UserOut
+
+
+class ActivityOut(msgspec.Struct):
+    user_id: BigInt
+    type: int | None
+    created_at: datetime | None
+    content: str | None
+    stream_url: str | None
+    emoji_id: BigInt | None
+
+
+class PresenceOut(msgspec.Struct):
+    user_id: BigInt
+    status: str | None
+    client_status: str | None
+    activities: list[ActivityOut] = []
+
+
+class SettingsOut(msgspec.Struct):
+    user_id: BigInt
+    locale: str | None
+    developer_mode: bool | None
+    theme: str | None
+    status: str | None
+    mfa_enabled: bool | None
+    friend_requests_off: bool | None
+
+
+class ReadStateOut(msgspec.Struct):
+    user_id: BigInt
+    channel_id: BigInt | None
+    last_read_message_id: BigInt | None
+    mention_count: int | None
@@ -0,0 +1,243 @@
+"""
+Elastic License 2.0
+
+Copyright Discend and/or licensed to Discend under one
+or more contributor license agreements. Licensed under the Elastic License;
+you may not use this file except in compliance with the Elastic License.
+"""
+import json
+import types
+import unittest
+from unittest import mock
+
+import msgspec
+from websockets.exceptions import ConnectionClosedError
+
+from gateway import on_connect
+from gateway.database import Event, NotApplied, encode_raw
+from gateway.registry import Registry
+from gateway.v1 import connection
+from gateway.v1.connection import v1Session
+
+IDENTIFY = json.dumps(
+    {
+        'op': 2,
+        'd': {
+            'token': 'token',
+            'intents': 0,
+            'properties': {'os': 'linux', 'browser': 'test', 'device': 'test'},
+        },
+    }
+)
+
+
+class FakeSocket:
+    def __init__(self, messages: list[str], drop_on_send: int) -> None:
+        self.messages = messages
+        self.sent: list[bytes | str] = []
+        self.close_code: int | None = None
+        # the nth frame sent finds the connection gone
+        self.drop_on_send = drop_on_send
+
+    def __aiter__(self):
+        return self._receive()
+
+    async def _receive(self):
+        for message in self.messages:
+            yield message
+
+    async def send(self, frame: bytes | str) -> None:
+        if len(self.sent) + 1 == self.drop_on_send:
+            raise ConnectionClosedError(None, None)
+
+        self.sent.append(frame)
+
+    async def close(self, code: int = 1000, reason: str = '') -> None:
+        self.close_code = code
+
+
+class SessionTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        with mock.patch.object(Registry, '_manage_kafka', mock.AsyncMock()):
+            self.registry = Registry()
+
+        connection.REGISTRY = self.registry
+        # identified sessions wait out the resume window before they're torn down
+        sleep = mock.patch('gateway.registry.sleep', mock.AsyncMock())
+        sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def tearDown(self) -> None:
+        connection.REGISTRY = None
+
+    def create_session(self, socket: FakeSocket, encoding: str = 'json') -> v1Session:
+        session = v1Session(version=1, encoding=encoding, compress=False, ws=socket)
+        # everything identify would read from the database
+        session.validate_token = mock.AsyncMock(
+            return_value=types.SimpleNamespace(id=1)
+        )
+        session.claim_connection = mock.AsyncMock(return_value=True)
+        session.get_joined_guild_ids = mock.AsyncMock(return_value=[10])
+        session.get_read_states = mock.AsyncMock(return_value=[])
+        session.get_settings = mock.AsyncMock(return_value=None)
+        session.get_relationships = mock.AsyncMock(return_value=([], []))
+        session.get_user_channels = mock.AsyncMock(return_value=([], []))
+        session.get_guilds = mock.AsyncMock(return_value=[{'id': '10'}])
+        session.delete_presence = mock.AsyncMock()
+        return session
+
+
+class SessionTeardownTest(SessionTestCase):
+    async def test_dropped_during_guild_create_is_unindexed(self) -> None:
+        # hello and READY go out, the connection drops on GUILD_CREATE
+        session = self.create_session(FakeSocket([IDENTIFY], drop_on_send=3))
+
+        await session.run()
+
+        self.assertFalse(session.identified)
+        self.assertNotIn(session.session_id, self.registry._sessions_by_id)
+        self.assertNotIn(10, self.registry._guild_to_sessions)
+        self.assertNotIn(1, self.registry._user_to_sessions)
+        self.assertNotIn(session.session_id, self.registry._queues)
+        # the presence was set when the connection was claimed
+        session.delete_presence.assert_awaited_once()
+
+    async def test_identified_session_is_unindexed_after_resume_window(self) -> None:
+        session = self.create_session(FakeSocket([IDENTIFY], drop_on_send=0))
+
+        await session.run()
+
+        self.assertTrue(session.identified)
+        self.assertNotIn(session.session_id, self.registry._sessions_by_id)
+        self.assertNotIn(10, self.registry._guild_to_sessions)
+        session.delete_presence.assert_awaited_once()
+
+
+class FrameValidationTest(SessionTestCase):
+    async def assert_closes_with(self, message: str | bytes, code: int) -> None:
+        socket = FakeSocket([message], drop_on_send=0)
+        session = self.create_session(socket)
+
+        await session.run()
+
+        self.assertEqual(socket.close_code, code)
+        self.assertFalse(session.identified)
+
+    async def test_malformed_frame(self) -> None:
+        await self.assert_closes_with('{"op": 2', 4002)
+        await self.assert_closes_with('{"op": "2", "d": {}}', 4002)
+
+    async def test_unknown_or_missing_op(self) -> None:
+        await self.assert_closes_with('{"op": 5, "d": {}}', 4003)
+        await self.assert_closes_with(json.dumps(json.loads(IDENTIFY)['d']), 4003)
+
+    async def test_invalid_or_missing_payload(self) -> None:
+        await self.assert_closes_with('{"op": 2, "d": {"token": "token"}}', 4004)
+        await self.assert_closes_with('{"op": 2}', 4004)
+
+    async def test_binary_frames_use_the_session_encoding(self) -> None:
+        socket = FakeSocket([msgspec.msgpack.encode(json.loads(IDENTIFY))], 0)
+        session = self.create_session(socket, encoding='msgpack')
+
+        await session.run()
+
+        self.assertTrue(session.identified)
+
+
+class ConnectionCountTest(SessionTestCase):
+    def create_limit(self, remaining: int, *races: int) -> mock.MagicMock:
+        limit = mock.MagicMock()
+        limit.objects.return_value.get.return_value.remaining = remaining
+        # each race is lost to an identify which left the given count behind
+        limit.objects.return_value.iff.return_value.update.side_effect = [
+            NotApplied({'[applied]': False, 'remaining': race}) for race in races
+        ] + [None]
+        return limit
+
+    def decrease(self, limit: mock.MagicMock) -> bool | None:
+        session = self.create_session(FakeSocket([], drop_on_send=0))
+        session.user_id = 1
+
+        with mock.patch.object(connection, 'GatewaySessionLimit', limit):
+            return session._decrease_connection_count()
+
+    async def test_lost_race_retries_with_the_winning_count(self) -> None:
+        limit = self.create_limit(5, 4)
+
+        self.assertTrue(self.decrease(limit))
+        iff = limit.objects.return_value.iff
+        self.assertEqual(iff.call_args_list[-1], mock.call(remaining=4))
+        # the count the race left behind was reused, not read again
+        limit.objects.return_value.get.assert_called_once()
+
+    async def test_exhausted_limit(self) -> None:
+        self.assertFalse(self.decrease(self.create_limit(5, 0)))
+
+    async def test_retries_are_bounded(self) -> None:
+        races = range(100, 100 - connection.CONNECTION_CLAIM_ATTEMPTS, -1)
+        limit = self.create_limit(101, *races)
+
+        self.assertIsNone(self.decrease(limit))
+        self.assertEqual(
+            limit.objects.return_value.iff.call_count,
+            connection.CONNECTION_CLAIM_ATTEMPTS,
+        )
+
+
+class UserDispatchTest(SessionTestCase):
+    async def test_user_events_are_broadcast_with_a_shared_payload(self) -> None:
+        sessions = []
+
+        for _ in range(2):
+            session = self.create_session(FakeSocket([], drop_on_send=0))
+            session.user_id = 1
+            session.floodgates_open = True
+            session._equip(self.registry)
+            sessions.append(session)
+
+        with mock.patch('gateway.registry.broadcast') as broadcast, mock.patch(
+            'gateway.registry.encode_raw', wraps=encode_raw
+        ) as encode:
+            self.registry._dispatch(Event('USER_UPDATE', {'id': '1'}, user_id=1))
+
+        encode.assert_called_once()
+        self.assertEqual(
+            {call.args[0][0] for call in broadcast.call_args_list},
+            {session._socket for session in sessions},
+        )
+
+
+class ConnectionSettingsTest(unittest.IsolatedAsyncioTestCase):
+    async def connect(self, query: str) -> tuple[mock.MagicMock, FakeSocket]:
+        socket = FakeSocket([], drop_on_send=0)
+
+        with mock.patch.object(on_connect, 'v1Session') as session:
+            session.return_value.run = mock.AsyncMock()
+            await on_connect.on_connection(socket, f'/?{query}')
+
+        return session, socket
+
+    async def test_settings_are_read_like_parse_qs(self) -> None:
+        session, _ = await self.connect(
+            'v=1&compress=&encoding=js%6Fn&encoding=msgpack'
+        )
+
+        session.assert_called_once_with(
+            version=1, encoding='json', compress=False, ws=mock.ANY
+        )
+
+    async def test_blank_version_is_missing(self) -> None:
+        session, socket = await self.connect('v=&encoding=json')
+
+        session.assert_not_called()
+        self.assertEqual(socket.close_code, 4001)
+
+    async def test_blank_encoding_is_missing(self) -> None:
+        session, socket = await self.connect('v=1&encoding=')
+
+        session.assert_not_called()
+        self.assertEqual(socket.close_code, 4001)
+
+
+if __name__ == '__main__':
+    unittest.main()